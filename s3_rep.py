@@ -1,14 +1,49 @@
+import argparse
 import boto3
+from boto3.s3.transfer import TransferConfig
+import csv
+import gzip
 import json
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timezone
+from json.encoder import encode_basestring_ascii
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import os
+import time
+from urllib.parse import unquote_plus
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the standard library
+    orjson = None
 
 # --- CONFIGURATION ---
 # TODO: Replace with your actual bucket names
 PRIMARY_BUCKET = os.getenv('PRIMARY_BUCKET')
 SECONDARY_BUCKET = os.getenv('SECONDARY_BUCKET')
 
+# --- DISCOVERY ---
+# How bucket contents are discovered:
+#   "scan"      - list the buckets with ListObjectsV2 (always up to date).
+#   "inventory" - read the latest S3 Inventory report (CSV format) for each bucket.
+#                 Much cheaper on very large buckets, but only as fresh as the
+#                 last report; objects changed since then are not seen. A key
+#                 missing from a report created before the last saved state may
+#                 simply have been copied there since, so such deletions are
+#                 deferred until a newer report arrives. Likewise, copies never
+#                 overwrite an object that has appeared at the destination since.
+DISCOVERY_MODE = os.getenv('DISCOVERY_MODE', 'scan')
+# Where S3 Inventory delivers its reports: s3://INVENTORY_BUCKET/INVENTORY_PREFIX/<bucket>/INVENTORY_CONFIG_ID/
+INVENTORY_BUCKET = os.getenv('INVENTORY_BUCKET')
+INVENTORY_PREFIX = os.getenv('INVENTORY_PREFIX', 'inventory')
+INVENTORY_CONFIG_ID = os.getenv('INVENTORY_CONFIG_ID')
+# Inventory report columns the sync cannot work without.
+INVENTORY_REQUIRED_FIELDS = ["Key", "Size", "LastModifiedDate", "ETag"]
+# Creation time of the inventory report read for each bucket, filled in by list_inventory_objects.
+inventory_report_times = {}
+
 # --- STATE MANAGEMENT KEYS ---
 # The main state file that tracks the last known good state of both buckets.
 STATE_KEY = "replication_state.json"
@@ -16,8 +51,68 @@ STATE_KEY = "replication_state.json"
 # Its existence indicates that the previous run may have failed.
 LOG_KEY = "replication.log.json"
 
-# Initialize the S3 client
-s3 = boto3.client("s3")
+# Listing metadata kept for every object: LastModified (datetime), Size and ETag.
+ObjectInfo = namedtuple("ObjectInfo", ["last_modified", "size", "etag"])
+
+# --- CONCURRENCY ---
+# Number of keys processed in parallel. Each action is a network-bound S3 call,
+# so threads scale well up to the size of the client's connection pool.
+MAX_WORKERS = 32
+# Maximum number of submitted-but-unfinished actions. Work is handed to the pool
+# in this bounded window rather than all at once, so memory stays flat on
+# buckets with millions of keys.
+MAX_IN_FLIGHT = MAX_WORKERS * 4
+# Number of top-level prefixes listed in parallel within a single bucket.
+LISTING_WORKERS = 16
+# Delimiter used to split a bucket's keyspace into independently listable prefixes.
+LISTING_DELIMITER = "/"
+
+# --- COPY SETTINGS ---
+# Objects below this size are copied with a single server-side CopyObject call.
+# Larger objects go through the managed transfer, which uses multipart copy.
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=MULTIPART_THRESHOLD,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=20,
+    use_threads=True,
+)
+
+# Maximum number of keys per DeleteObjects request (the S3 limit).
+DELETE_BATCH_SIZE = 1000
+
+# --- CHECKPOINTING ---
+# The progress log is flushed after this many completed keys or this many
+# seconds, whichever comes first, instead of after every key.
+CHECKPOINT_EVERY_KEYS = 100
+CHECKPOINT_EVERY_SECONDS = 5
+
+# gzip level used for the state file. The state is highly repetitive, so
+# a moderate level already compresses it well.
+STATE_COMPRESSLEVEL = 6
+
+# Shared "last_seen_in" values used when rebuilding the state.
+BOTH_LOCATIONS = ("primary", "secondary")
+PRIMARY_ONLY = ("primary",)
+SECONDARY_ONLY = ("secondary",)
+
+# Sentinel for a missing timestamp; timezone-aware so it compares with S3 times.
+MIN_TIME = datetime.min.replace(tzinfo=timezone.utc)
+
+# Initialize the S3 client with a connection pool large enough for every parallel
+# stage (copy workers, listing fan-out), TCP keepalive on pooled connections and
+# throttling-aware retries. Request bodies are not SHA-256 signed; the transport
+# is HTTPS, so the payload is still protected in transit.
+s3 = boto3.client(
+    "s3",
+    config=Config(
+        max_pool_connections=128,
+        tcp_keepalive=True,
+        retries={"max_attempts": 10, "mode": "adaptive"},
+        signature_version="s3v4",
+        s3={"addressing_style": "virtual", "payload_signing_enabled": False},
+    ),
+)
 
 
 def now():
@@ -25,83 +120,295 @@ def now():
     return datetime.now(timezone.utc).isoformat()
 
 
+def parse_time(value):
+    """Parse an ISO timestamp written by now(). Missing values sort before any real time."""
+    if not value:
+        return MIN_TIME
+    return datetime.fromisoformat(value)
+
+
+def _json_dumps(obj):
+    """Serialize obj to compact JSON bytes, using orjson when it is installed."""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def _json_loads(data):
+    """Parse JSON bytes, using orjson when it is installed."""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data.decode("utf-8"))
+
+
+def _head_state(bucket):
+    """
+    HEAD the state file in a bucket.
+    Returns (response, missing): response is None if the request failed, and
+    missing is True only when the bucket definitely has no state file.
+    """
+    try:
+        return s3.head_object(Bucket=bucket, Key=STATE_KEY), False
+    except ClientError as e:
+        return None, e.response["Error"]["Code"] in ("404", "NoSuchKey")
+
+
 def load_state():
     """
     Load the most recent replication state from either bucket.
     This provides redundancy if one bucket is temporarily down.
+    Both state files are probed with HEAD first and only the newest is downloaded.
+    Returns (state, etags), where etags maps each bucket to the ETag of its
+    state file, or None if the bucket has no state file yet.
     """
-    state = None
-    # Check both buckets and use the newest state file
-    for bucket in [PRIMARY_BUCKET, SECONDARY_BUCKET]:
-        try:
-            obj = s3.get_object(Bucket=bucket, Key=STATE_KEY)
-            candidate = json.loads(obj["Body"].read().decode("utf-8"))
-            if not state or candidate.get("last_updated", "") > state.get("last_updated", ""):
-                state = candidate
-        except ClientError:
+    buckets = [PRIMARY_BUCKET, SECONDARY_BUCKET]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        heads = list(executor.map(_head_state, buckets))
+
+    etags = {}
+    candidates = []
+    for bucket, (head, missing) in zip(buckets, heads):
+        if head is None:
+            if missing:
+                etags[bucket] = None
             continue  # Silently ignore if the state file is not found in one bucket
+        etags[bucket] = head["ETag"]
+        # Prefer the logical update time recorded by save_state, if present
+        updated = head.get("Metadata", {}).get("last-updated")
+        candidates.append((parse_time(updated) if updated else head["LastModified"], bucket))
 
-    if state:
-        return state
+    # Download the newest state file, falling back to the other bucket if that fails
+    for _, bucket in sorted(candidates, key=lambda c: c[0], reverse=True):
+        try:
+            obj = s3.get_object(Bucket=bucket, Key=STATE_KEY)
+            body = obj["Body"].read()
+            # State files written by older versions are plain, uncompressed JSON
+            if obj.get("ContentEncoding") == "gzip":
+                body = gzip.decompress(body)
+            etags[bucket] = obj["ETag"]
+            return _json_loads(body), etags
+        except ClientError as e:
+            print(f"⚠️ Could not read state file from {bucket}: {e}")
 
     # If no state file exists anywhere, start with a fresh state.
     print("No state file found. Starting fresh.")
-    return {"files": {}, "last_updated": now()}
+    return {"files": {}, "last_updated": now()}, etags
+
 
+def files_state_equal(old_files, new_files):
+    """Return True if two state['files'] dicts agree on every key's locations and source, ignoring sync times."""
+    if len(old_files) != len(new_files):
+        return False
+    for key, entry in new_files.items():
+        previous = old_files.get(key)
+        if (previous is None
+                or previous["source"] != entry["source"]
+                or tuple(previous["last_seen_in"]) != tuple(entry["last_seen_in"])):
+            return False
+    return True
 
-def save_state(state):
-    """Save the final state to both buckets for redundancy."""
+
+def save_state(state, etags=None):
+    """
+    Save the final state to both buckets for redundancy.
+    When the ETag seen by load_state is known, the write is conditional on it,
+    so a state file changed by a concurrent run is not silently overwritten.
+    """
+    etags = etags or {}
     state["last_updated"] = now()
-    encoded = json.dumps(state, indent=2).encode("utf-8")
+    encoded = gzip.compress(_json_dumps(state), compresslevel=STATE_COMPRESSLEVEL)
 
     for bucket in [PRIMARY_BUCKET, SECONDARY_BUCKET]:
+        conditions = {}
+        if bucket in etags:
+            if etags[bucket]:
+                conditions["IfMatch"] = etags[bucket]
+            else:
+                conditions["IfNoneMatch"] = "*"
         try:
-            s3.put_object(Bucket=bucket, Key=STATE_KEY, Body=encoded)
+            s3.put_object(
+                Bucket=bucket,
+                Key=STATE_KEY,
+                Body=encoded,
+                ContentEncoding="gzip",
+                ContentType="application/json",
+                Metadata={"last-updated": state["last_updated"]},
+                **conditions,
+            )
         except ClientError as e:
-            print(f"⚠️ Could not save final state to {bucket}: {e}")
+            if e.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict"):
+                print(f"⚠️ State file in {bucket} was changed by another writer; not overwriting it.")
+            else:
+                print(f"⚠️ Could not save final state to {bucket}: {e}")
 
 
-def list_bucket_objects(bucket):
-    """Return a dictionary {key: last_modified} for all objects in a bucket."""
+def _list_prefix(bucket, prefix, delimiter=None):
+    """
+    List the objects under a prefix.
+    Returns ({key: ObjectInfo}, [common prefixes]); prefixes are only returned when a delimiter is given.
+    """
+    objects = {}
+    prefixes = []
+    params = {"Bucket": bucket, "Prefix": prefix}
+    if delimiter:
+        params["Delimiter"] = delimiter
+
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(**params):
+        for obj in page.get("Contents", []):
+            # Ignore the state and log files themselves
+            if obj["Key"] not in [STATE_KEY, LOG_KEY]:
+                objects[obj["Key"]] = ObjectInfo(obj["LastModified"], obj["Size"], obj["ETag"])
+        prefixes.extend(p["Prefix"] for p in page.get("CommonPrefixes", []))
+    return objects, prefixes
+
+
+def _read_inventory_file(key, fields):
+    """Parse one gzipped CSV data file of an inventory report into {key: ObjectInfo}."""
+    obj = s3.get_object(Bucket=INVENTORY_BUCKET, Key=key)
+    objects = {}
+    with gzip.open(obj["Body"], "rt", encoding="utf-8", newline="") as text:
+        for row in csv.reader(text):
+            record = dict(zip(fields, row))
+            # Versioned inventories list every version; keep only live, current objects
+            if record.get("IsLatest", "true") != "true" or record.get("IsDeleteMarker", "false") == "true":
+                continue
+            object_key = unquote_plus(record["Key"])
+            if object_key in [STATE_KEY, LOG_KEY]:
+                continue
+            objects[object_key] = ObjectInfo(
+                datetime.fromisoformat(record["LastModifiedDate"].replace("Z", "+00:00")),
+                int(record["Size"]),
+                # Inventory ETags are unquoted, unlike those returned by ListObjectsV2
+                f'"{record["ETag"]}"',
+            )
+    return objects
+
+
+def validate_discovery_config():
+    """Raise ValueError if the discovery settings are incomplete, before anything is listed or changed."""
+    if DISCOVERY_MODE not in ("scan", "inventory"):
+        raise ValueError(f"unknown DISCOVERY_MODE {DISCOVERY_MODE!r}; expected 'scan' or 'inventory'")
+    if DISCOVERY_MODE == "inventory":
+        settings = {"INVENTORY_BUCKET": INVENTORY_BUCKET, "INVENTORY_CONFIG_ID": INVENTORY_CONFIG_ID}
+        missing = [name for name, value in settings.items() if not value]
+        if missing:
+            raise ValueError(f"DISCOVERY_MODE='inventory' requires {', '.join(missing)} to be set")
+
+
+def list_inventory_objects(bucket):
+    """
+    Return a dictionary {key: ObjectInfo} for a bucket, read from its latest S3 Inventory report.
+    Raises ValueError or ClientError if the report is missing or unusable; an empty
+    result would look like every object had been deleted from the bucket.
+    """
+    report_prefix = f"{INVENTORY_PREFIX}/{bucket}/{INVENTORY_CONFIG_ID}/"
+    # Each report lives in a folder named after its creation time, e.g. 2024-01-31T01-00Z/
+    _, folders = _list_prefix(INVENTORY_BUCKET, report_prefix, "/")
+    folders = [f for f in folders if f[len(report_prefix):][:1].isdigit()]
+    if not folders:
+        raise ValueError(f"no inventory report found under s3://{INVENTORY_BUCKET}/{report_prefix}")
+
+    obj = s3.get_object(Bucket=INVENTORY_BUCKET, Key=max(folders) + "manifest.json")
+    manifest = json.loads(obj["Body"].read().decode("utf-8"))
+    if manifest.get("fileFormat") != "CSV":
+        raise ValueError(f"unsupported inventory format {manifest.get('fileFormat')!r}; only CSV is supported")
+    if "creationTimestamp" not in manifest:
+        raise ValueError(f"inventory manifest for {bucket} has no creationTimestamp")
+    fields = [field.strip() for field in manifest.get("fileSchema", "").split(",")]
+    missing = [field for field in INVENTORY_REQUIRED_FIELDS if field not in fields]
+    if missing:
+        raise ValueError(f"inventory report for {bucket} lacks required fields: {', '.join(missing)}")
+
     result = {}
+    with ThreadPoolExecutor(max_workers=LISTING_WORKERS) as executor:
+        for objects in executor.map(lambda f: _read_inventory_file(f["key"], fields), manifest["files"]):
+            result.update(objects)
+    # creationTimestamp is in milliseconds since the epoch
+    inventory_report_times[bucket] = datetime.fromtimestamp(int(manifest["creationTimestamp"]) / 1000, timezone.utc)
+    return result
+
+
+def stale_listing_buckets(state):
+    """
+    Return the buckets whose listing may be missing objects copied there by the last run.
+    Only inventory reports can be stale: one created before the state was last
+    saved does not reflect that run's copies.
+    """
+    if DISCOVERY_MODE != "inventory":
+        return set()
+    last_run = parse_time(state.get("last_updated"))
+    return {bucket for bucket, created in inventory_report_times.items() if created <= last_run}
+
+
+def list_bucket_objects(bucket):
+    """
+    Return a dictionary {key: ObjectInfo} for all objects in a bucket.
+    The top level is listed with a delimiter, then each top-level prefix is
+    paginated on its own thread. Together they cover every key exactly once.
+    With DISCOVERY_MODE="inventory" the latest S3 Inventory report is read instead.
+    Any listing error is re-raised so the run aborts: a partial or empty listing
+    would make the missing keys look deleted from this bucket.
+    """
     try:
-        paginator = s3.get_paginator("list_objects_v2")
-        for page in paginator.paginate(Bucket=bucket):
-            for obj in page.get("Contents", []):
-                # Ignore the state and log files themselves
-                if obj["Key"] not in [STATE_KEY, LOG_KEY]:
-                    result[obj["Key"]] = obj["LastModified"].isoformat()
-    except ClientError as e:
+        if DISCOVERY_MODE == "inventory":
+            return list_inventory_objects(bucket)
+
+        result, prefixes = _list_prefix(bucket, "", LISTING_DELIMITER)
+        if prefixes:
+            with ThreadPoolExecutor(max_workers=LISTING_WORKERS) as executor:
+                for objects, _ in executor.map(lambda prefix: _list_prefix(bucket, prefix), prefixes):
+                    result.update(objects)
+        return result
+    except (ClientError, ValueError) as e:
         print(f"❌ CRITICAL: Could not list objects in bucket {bucket}. Error: {e}")
-    return result
+        raise
+
+
+def list_both_buckets():
+    """List the primary and secondary buckets concurrently. Returns (primary_files, secondary_files)."""
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        p_future = executor.submit(list_bucket_objects, PRIMARY_BUCKET)
+        s_future = executor.submit(list_bucket_objects, SECONDARY_BUCKET)
+        return p_future.result(), s_future.result()
 
 
 def rebuild_files_state(primary_files, secondary_files):
-    """Rebuilds the state['files'] dictionary from scratch after all sync actions are complete."""
-    files = {}
-    all_keys = set(primary_files) | set(secondary_files)
-
-    for key in all_keys:
-        locations = []
-        if key in primary_files:
-            locations.append("primary")
-        if key in secondary_files:
-            locations.append("secondary")
-        
-        # Determine the source based on modification time
-        p_time = primary_files.get(key, "")
-        s_time = secondary_files.get(key, "")
+    """
+    Rebuilds the state['files'] dictionary from scratch after all sync actions are complete.
+    Every entry has one of five possible values, so those are built once and
+    shared between keys; callers must treat the entries as read-only.
+    """
+    primary_keys = primary_files.keys()
+    secondary_keys = secondary_files.keys()
+    # The rebuild is logically a single instant, so every entry shares one timestamp
+    synced_at = now()
+    both_entries = {
+        source: {"last_synced": synced_at, "last_seen_in": BOTH_LOCATIONS, "source": source}
+        for source in ("equal", "primary", "secondary")
+    }
+
+    # Keys present on only one side are filled in by dict.fromkeys, without a Python-level loop
+    files = dict.fromkeys(
+        primary_keys - secondary_keys,
+        {"last_synced": synced_at, "last_seen_in": PRIMARY_ONLY, "source": "primary"},
+    )
+    files.update(dict.fromkeys(
+        secondary_keys - primary_keys,
+        {"last_synced": synced_at, "last_seen_in": SECONDARY_ONLY, "source": "secondary"},
+    ))
+
+    # Keys present on both sides: the source is decided by content, then modification time
+    for key in primary_keys & secondary_keys:
+        p_obj = primary_files[key]
+        s_obj = secondary_files[key]
         source = "equal"
-        if p_time > s_time:
-            source = "primary"
-        elif s_time > p_time:
-            source = "secondary"
-
-        files[key] = {
-            "last_synced": now(),
-            "last_seen_in": locations,
-            "source": source,
-        }
+        if p_obj.etag != s_obj.etag:
+            if p_obj.last_modified > s_obj.last_modified:
+                source = "primary"
+            elif s_obj.last_modified > p_obj.last_modified:
+                source = "secondary"
+        files[key] = both_entries[source]
     return files
 
 
@@ -119,15 +426,24 @@ def load_progress_log():
         return set()
 
 
-def save_progress_log(completed_keys):
-    """Saves the list of completed keys to a temporary log file."""
-    encoded = json.dumps(list(completed_keys), indent=2).encode("utf-8")
-    for bucket in [PRIMARY_BUCKET, SECONDARY_BUCKET]:
-        try:
-            s3.put_object(Bucket=bucket, Key=LOG_KEY, Body=encoded)
-        except ClientError as e:
-            # This is not critical, but a warning is useful
-            print(f"⚠️ Could not save progress log to {bucket}: {e}")
+def encode_log_entries(keys):
+    """Encodes keys as comma-terminated JSON strings, ready to append to a progress log buffer."""
+    return b"".join(encode_basestring_ascii(key).encode("ascii") + b"," for key in keys)
+
+
+def save_progress_log(log_buffer):
+    """
+    Saves the completed keys to a temporary log file.
+    log_buffer holds the keys already encoded by encode_log_entries, so the
+    log is only wrapped in brackets here rather than re-serialized.
+    Only the primary bucket is written, since load_progress_log reads only from there.
+    """
+    encoded = b"[" + bytes(log_buffer[:-1]) + b"]"
+    try:
+        s3.put_object(Bucket=PRIMARY_BUCKET, Key=LOG_KEY, Body=encoded)
+    except ClientError as e:
+        # This is not critical, but a warning is useful
+        print(f"⚠️ Could not save progress log to {PRIMARY_BUCKET}: {e}")
 
 
 def delete_progress_log():
@@ -139,9 +455,163 @@ def delete_progress_log():
             print(f"⚠️ Could not delete progress log from {bucket}: {e}")
 
 
-def replicate_resilient():
-    """Performs a resilient, two-way sync of the S3 buckets."""
-    state = load_state()
+def _head_object(bucket, key):
+    """HEAD an object. Returns the response, or None if the object does not exist."""
+    try:
+        return s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+
+
+def copy_key(source_bucket, dest_bucket, key, size):
+    """
+    Copies a single object between buckets.
+    Small objects use one server-side CopyObject request; large objects fall
+    back to the managed multipart transfer. The size comes from the listing.
+    Returns the destination's ObjectInfo, whose ETag and LastModified can differ from the source's.
+
+    In inventory mode the listing can be hours old, so the destination may have
+    gained the key since, or the source may have lost it. The copy then never
+    overwrites an existing object and tolerates a missing source; either way it
+    is skipped and None is returned, leaving the key to be decided on the next run.
+    """
+    inventory = DISCOVERY_MODE == "inventory"
+    if size < MULTIPART_THRESHOLD:
+        conditions = {"IfNoneMatch": "*"} if inventory else {}
+        try:
+            response = s3.copy_object(
+                CopySource={"Bucket": source_bucket, "Key": key}, Bucket=dest_bucket, Key=key, **conditions
+            )
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if inventory and code in ("PreconditionFailed", "ConditionalRequestConflict"):
+                print(f"⏭️ {key}: Already present in {dest_bucket} → Skipping copy...")
+                return None
+            if inventory and code == "NoSuchKey":
+                print(f"⏭️ {key}: No longer in {source_bucket} → Skipping copy...")
+                return None
+            raise
+        copied = response["CopyObjectResult"]
+        return ObjectInfo(copied["LastModified"], size, copied["ETag"])
+
+    if inventory and _head_object(dest_bucket, key):
+        print(f"⏭️ {key}: Already present in {dest_bucket} → Skipping copy...")
+        return None
+
+    # The managed transfer returns nothing, so read the new object's metadata back
+    try:
+        s3.copy({"Bucket": source_bucket, "Key": key}, dest_bucket, key, Config=TRANSFER_CONFIG)
+    except ClientError as e:
+        # The transfer HEADs the source first, which reports a missing key as 404
+        if inventory and e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            print(f"⏭️ {key}: No longer in {source_bucket} → Skipping copy...")
+            return None
+        raise
+    head = s3.head_object(Bucket=dest_bucket, Key=key)
+    return ObjectInfo(head["LastModified"], head["ContentLength"], head["ETag"])
+
+
+def delete_keys(bucket, keys):
+    """
+    Deletes a batch of keys with a single DeleteObjects request.
+    Returns {key: error} for the keys S3 could not delete.
+    """
+    response = s3.delete_objects(
+        Bucket=bucket,
+        Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+    )
+    return {err["Key"]: f"{err.get('Code')}: {err.get('Message')}" for err in response.get("Errors", [])}
+
+
+def _iter_tasks(copies, deletes):
+    """Yields (function, args, keys) for every planned action, batching deletions per bucket."""
+    for key, source_bucket, dest_bucket, size in copies:
+        yield copy_key, (source_bucket, dest_bucket, key, size), [key]
+    for bucket, keys in deletes.items():
+        for i in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[i:i + DELETE_BATCH_SIZE]
+            yield delete_keys, (bucket, batch), batch
+
+
+def plan_action(key, primary_files, secondary_files, state, stale_buckets=()):
+    """
+    Decides the sync action required for a single key.
+    Returns ("copy", source_bucket, dest_bucket, size), ("delete", bucket),
+    ("defer",) if a deletion can't be trusted yet, or None if nothing needs to be done.
+    A key missing from a bucket in stale_buckets is never treated as deleted there.
+    """
+    p_obj = primary_files.get(key)
+    s_obj = secondary_files.get(key)
+    in_state = key in state.get("files", {})
+
+    # Exists in primary, missing in secondary
+    if p_obj and not s_obj:
+        if in_state and "secondary" in state["files"][key]["last_seen_in"]:
+            # The file existed in secondary before → it was deleted there
+            if SECONDARY_BUCKET in stale_buckets:
+                print(f"⏸️ {key}: Missing from an outdated secondary listing → Deferring deletion...")
+                return ("defer",)
+            print(f"🗑️ {key}: Deleted from secondary → Removing from primary...")
+            return ("delete", PRIMARY_BUCKET)
+        # New in primary → copy to secondary
+        print(f"📤 {key}: New in primary → Copying to secondary...")
+        return ("copy", PRIMARY_BUCKET, SECONDARY_BUCKET, p_obj.size)
+
+    # Exists in secondary, missing in primary
+    if s_obj and not p_obj:
+        if in_state and "primary" in state["files"][key]["last_seen_in"]:
+            # The file existed in primary before → it was deleted there
+            if PRIMARY_BUCKET in stale_buckets:
+                print(f"⏸️ {key}: Missing from an outdated primary listing → Deferring deletion...")
+                return ("defer",)
+            print(f"🗑️ {key}: Deleted from primary → Removing from secondary...")
+            return ("delete", SECONDARY_BUCKET)
+        # New in secondary → copy to primary
+        print(f"📥 {key}: New in secondary → Copying to primary...")
+        return ("copy", SECONDARY_BUCKET, PRIMARY_BUCKET, s_obj.size)
+
+    # --- (Optional) Exists in both, check for updates ---
+    # Identical ETags mean identical bytes, so no copy is needed.
+    # Enabling this also requires replicate_resilient to plan keys present in both buckets.
+    # if p_obj and s_obj and p_obj.etag != s_obj.etag:
+    #     if p_obj.last_modified > s_obj.last_modified:
+    #         print(f"🔄 {key}: Newer in primary → Updating secondary...")
+    #         return ("copy", PRIMARY_BUCKET, SECONDARY_BUCKET, p_obj.size)
+    #     elif s_obj.last_modified > p_obj.last_modified:
+    #         print(f"🔄 {key}: Newer in secondary → Updating primary...")
+    #         return ("copy", SECONDARY_BUCKET, PRIMARY_BUCKET, s_obj.size)
+
+    # --- Deleted from both sides (known from state) ---
+    # If a file was in the state but is now in neither p_obj nor s_obj,
+    # no action is needed. The final state rebuild will correctly remove it.
+    return None
+
+
+def _apply_to_listing(fn, args, keys, result, files_by_bucket):
+    """
+    Mirrors completed actions in the in-memory listings so they can be reused for the final state.
+    result is the task's return value: the destination's ObjectInfo for a copy.
+    """
+    if fn is copy_key:
+        dest_bucket = args[1]
+        for key in keys:
+            files_by_bucket[dest_bucket][key] = result
+    else:
+        bucket = args[0]
+        for key in keys:
+            files_by_bucket[bucket].pop(key, None)
+
+
+def replicate_resilient(verify=False):
+    """
+    Performs a resilient, two-way sync of the S3 buckets.
+    The final state is built from the initial listings updated with the actions
+    taken; with verify=True both buckets are listed again instead.
+    """
+    validate_discovery_config()
+    state, state_etags = load_state()
     
     completed_in_prior_run = load_progress_log()
     if completed_in_prior_run:
@@ -149,91 +619,131 @@ def replicate_resilient():
 
     # This set will track keys successfully processed in THIS run
     completed_this_run = set(completed_in_prior_run)
+    # Append-only JSON encoding of completed_this_run, written out at each checkpoint
+    log_buffer = bytearray(encode_log_entries(completed_in_prior_run))
 
     print("🔎 Discovering objects in both buckets...")
-    primary_files = list_bucket_objects(PRIMARY_BUCKET)
-    secondary_files = list_bucket_objects(SECONDARY_BUCKET)
-
-    # Combine all keys: those currently in buckets and those from the last known state
-    all_keys = set(primary_files) | set(secondary_files) | set(state.get("files", {}))
-    
-    print(f"Found {len(all_keys)} total unique objects to process.")
-
-    for key in sorted(list(all_keys)):
+    primary_files, secondary_files = list_both_buckets()
+
+    # Every action concerns a key present in exactly one bucket: keys in both are
+    # in sync, and keys only in the last known state were deleted from both sides.
+    # Only the symmetric difference needs planning; if it is empty there is nothing to do.
+    unsynced_keys = primary_files.keys() ^ secondary_files.keys()
+
+    print(f"Found {len(unsynced_keys)} objects present in only one bucket.")
+
+    # Decide every action up front: copies run one per key, deletions are batched per bucket.
+    # Actions run concurrently, so there is no benefit in sorting the keys first.
+    copies = []
+    deletes = {PRIMARY_BUCKET: [], SECONDARY_BUCKET: []}
+    deferred = []
+    stale_buckets = stale_listing_buckets(state)
+    for key in unsynced_keys:
         if key in completed_this_run:
             continue
-
-        p_time = primary_files.get(key)
-        s_time = secondary_files.get(key)
-        in_state = key in state.get("files", {})
-        
-        action_taken = False
-        
-        try:
-            # Exists in primary, missing in secondary
-            if p_time and not s_time:
-                if in_state and "secondary" in state["files"][key]["last_seen_in"]:
-                    # The file existed in secondary before → it was deleted there
-                    print(f"🗑️ {key}: Deleted from secondary → Removing from primary...")
-                    s3.delete_object(Bucket=PRIMARY_BUCKET, Key=key)
-                    action_taken = True
-                else:
-                    # New in primary → copy to secondary
-                    print(f"📤 {key}: New in primary → Copying to secondary...")
-                    s3.copy({"Bucket": PRIMARY_BUCKET, "Key": key}, SECONDARY_BUCKET, key)
-                    action_taken = True
-
-            # Exists in secondary, missing in primary
-            elif s_time and not p_time:
-                if in_state and "primary" in state["files"][key]["last_seen_in"]:
-                    # The file existed in primary before → it was deleted there
-                    print(f"🗑️ {key}: Deleted from primary → Removing from secondary...")
-                    s3.delete_object(Bucket=SECONDARY_BUCKET, Key=key)
-                    action_taken = True
-                    
-                else:
-                    # New in secondary → copy to primary
-                    print(f"📥 {key}: New in secondary → Copying to primary...")
-                    s3.copy({"Bucket": SECONDARY_BUCKET, "Key": key}, PRIMARY_BUCKET, key)
-                    action_taken = True
-
-            # --- (Optional) Exists in both, check for updates ---
-            # elif p_time and s_time:
-            #     if p_time > s_time:
-            #         print(f"🔄 {key}: Newer in primary → Updating secondary...")
-            #         s3.copy({"Bucket": PRIMARY_BUCKET, "Key": key}, SECONDARY_BUCKET, key)
-            #         action_taken = True
-            #     elif s_time > p_time:
-            #         print(f"🔄 {key}: Newer in secondary → Updating primary...")
-            #         s3.copy({"Bucket": SECONDARY_BUCKET, "Key": key}, PRIMARY_BUCKET, key)
-            #         action_taken = True
-
-            
-            # --- Deleted from both sides (known from state) ---
-            # If a file was in the state but is now in neither p_time nor s_time,
-            # no action is needed. The final state rebuild will correctly remove it.
-
-            if action_taken:
-                # --- CHECKPOINT ---
-                completed_this_run.add(key)
-                save_progress_log(completed_this_run)
-
-        except ClientError as e:
-            print(f"❌ ERROR processing {key}. It will be retried on the next run. Error: {e}")
-            # Stop the script on error to prevent inconsistent state
-            return
+        action = plan_action(key, primary_files, secondary_files, state, stale_buckets)
+        if action is None:
+            continue
+        if action[0] == "defer":
+            deferred.append(key)
+        elif action[0] == "delete":
+            deletes[action[1]].append(key)
+        else:
+            copies.append((key,) + action[1:])
+
+    failed = False
+    last_flushed_count = len(completed_this_run)
+    last_flush_ts = time.monotonic()
+
+    files_by_bucket = {PRIMARY_BUCKET: primary_files, SECONDARY_BUCKET: secondary_files}
+    tasks = _iter_tasks(copies, deletes)
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # Each in-flight future maps to its (function, args, keys)
+            in_flight = {}
+            while True:
+                # Top up the window; after a failure no new work is scheduled
+                while not failed and len(in_flight) < MAX_IN_FLIGHT:
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    fn, args, keys = task
+                    in_flight[executor.submit(fn, *args)] = (fn, args, keys)
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    fn, args, keys = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except ClientError as e:
+                        result = None
+                        errors = dict.fromkeys(keys, e)
+                    else:
+                        # Deletions report per-key failures; a copy that returns has succeeded
+                        errors = result if fn is delete_keys else {}
+
+                    for key, error in errors.items():
+                        print(f"❌ ERROR processing {key}. It will be retried on the next run. Error: {error}")
+                    if errors:
+                        # Stop scheduling new work; in-flight actions are allowed to finish
+                        failed = True
+
+                    # A copy skipped because its listing was outdated returns None and completes nothing
+                    succeeded = [] if result is None else [key for key in keys if key not in errors]
+                    completed_this_run.update(succeeded)
+                    log_buffer += encode_log_entries(succeeded)
+                    _apply_to_listing(fn, args, succeeded, result, files_by_bucket)
+
+                    # --- CHECKPOINT ---
+                    # Flush in batches so the log is not rewritten for every key
+                    if (len(completed_this_run) - last_flushed_count >= CHECKPOINT_EVERY_KEYS
+                            or time.monotonic() - last_flush_ts >= CHECKPOINT_EVERY_SECONDS):
+                        if len(completed_this_run) != last_flushed_count:
+                            save_progress_log(log_buffer)
+                            last_flushed_count = len(completed_this_run)
+                        last_flush_ts = time.monotonic()
+    finally:
+        # Record whatever completed since the last checkpoint, even on failure
+        if len(completed_this_run) != last_flushed_count:
+            save_progress_log(log_buffer)
+
+    if failed:
+        # Stop the script on error to prevent inconsistent state
+        return
 
     print("\n✅ Sync actions complete. Rebuilding final state...")
-    final_primary_files = list_bucket_objects(PRIMARY_BUCKET)
-    final_secondary_files = list_bucket_objects(SECONDARY_BUCKET)
-    state["files"] = rebuild_files_state(final_primary_files, final_secondary_files)
-    save_state(state)
+    if verify:
+        # Re-list to also pick up changes made by other writers during the run
+        primary_files, secondary_files = list_both_buckets()
+    files = rebuild_files_state(primary_files, secondary_files)
+    # Deferred keys keep their previous entry so the deletion is decided again on the next run
+    for key in deferred:
+        files[key] = state["files"][key]
+    # Skip the upload when nothing changed and both buckets hold the same state file.
+    # Matching ETags mean identical bytes; if they differ (a stale copy, or non-MD5
+    # ETags such as with SSE-KMS) the state is uploaded again.
+    both_current = state_etags.get(PRIMARY_BUCKET) and state_etags.get(PRIMARY_BUCKET) == state_etags.get(SECONDARY_BUCKET)
+    if files_state_equal(state.get("files", {}), files) and both_current:
+        print("State unchanged. Skipping state upload.")
+    else:
+        state["files"] = files
+        save_state(state, state_etags)
 
     print("🧹 Cleaning up progress log.")
     delete_progress_log()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Two-way replication between two S3 buckets.")
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="re-list both buckets after syncing instead of reusing the initial listing",
+    )
+    args = parser.parse_args()
+
     print(f"--- Starting S3 replication job at {now()} ---")
-    replicate_resilient()
+    replicate_resilient(verify=args.verify)
     print(f"--- Replication finished successfully at {now()} ---")
\ No newline at end of file